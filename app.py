@@ -1,7 +1,21 @@
+import hashlib
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
 import requests
-from flask import Flask, abort, jsonify, render_template, request
-from flask_jwt_extended import JWTManager, create_access_token, get_jwt_identity, jwt_required
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, abort, g, jsonify, render_template, request, stream_with_context
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
+from flask_jwt_extended import JWTManager, create_access_token, get_jwt, get_jwt_identity, jwt_required
+from sqlalchemy import bindparam, delete, inspect, or_, select, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 
 from config import Config, get_ssl_context
 from models import Joke, User, db
@@ -9,6 +23,90 @@ from models import Joke, User, db
 # Base URL for the external API
 CHUCK_API_BASE = "https://api.chucknorris.io/jokes"
 
+# Shared HTTP session for the external API so connections (and the TLS
+# handshake) are reused across requests instead of reopened on every call.
+_chuck_session = requests.Session()
+_chuck_session.headers.update({"User-Agent": "get-chucked/1.0", "Accept": "application/json"})
+_chuck_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504]),
+    ),
+)
+
+# The category list rarely changes, so cache it in-process for an hour.
+CATEGORIES_TTL = 3600
+_cat_cache = TTLCache(maxsize=1, ttl=CATEGORIES_TTL)
+# Upstream failures are remembered briefly so callers fail fast during an outage.
+CATEGORIES_FAILURE_TTL = 30
+_cat_fail_cache = TTLCache(maxsize=1, ttl=CATEGORIES_FAILURE_TTL)
+# Guards the caches only; never held across the upstream call.
+_cat_lock = threading.Lock()
+# Taken only on a cache miss so a single thread refetches while the rest wait.
+_cat_fetch_lock = threading.Lock()
+
+# Reused statement for auth lookups so the compiled SQL stays in SQLAlchemy's cache.
+_USER_BY_NAME = select(User).where(User.username == bindparam("u")).limit(1)
+
+# Maximum number of sub-requests accepted by the /batch aggregator.
+MAX_AGGREGATE = 10
+
+# Maximum number of jokes fetched by one /random/batch call.
+MAX_BATCH = 20
+# Worker threads for fanning out independent upstream fetches (/random/batch).
+_fetch_pool = ThreadPoolExecutor(max_workers=10, thread_name_prefix="chuck-fetch")
+
+
+def fetch_random_joke(category=None):
+    """
+    Fetch one random joke from the external API.
+    Returns (external_id, value, category); raises requests.RequestException on failure.
+    """
+    params = {"category": category} if category else None
+    resp = _chuck_session.get(f"{CHUCK_API_BASE}/random", params=params, timeout=5)
+    resp.raise_for_status()
+
+    data = resp.json()
+    cats = data.get("categories") or []
+    return data.get("id"), data.get("value"), cats[0] if cats else None
+
+
+def cached_categories():
+    """Return (categories or None, recently_failed) from the in-process caches."""
+    with _cat_lock:
+        return _cat_cache.get("v"), "v" in _cat_fail_cache
+
+
+def upsert_insert(model):
+    """Dialect-specific INSERT construct that supports ON CONFLICT clauses."""
+    if db.engine.dialect.name == "sqlite":
+        return sqlite_insert(model)
+    return pg_insert(model)
+
+
+class ORJSONProvider(JSONProvider):
+    """JSON provider backed by orjson; encodes datetimes natively (naive = UTC)."""
+
+    option = orjson.OPT_NAIVE_UTC
+
+    def dumps(self, obj, **kwargs):
+        """Serialize to str; stdlib options such as indent/sort_keys are ignored."""
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def loads(self, s, **kwargs):
+        """Deserialize str or bytes; stdlib options are ignored."""
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Same argument rules as jsonify(): one value, several (a list), or kwargs (a dict).
+        if args and kwargs:
+            raise TypeError("response() takes either args or kwargs, not both")
+        obj = kwargs or (args[0] if len(args) == 1 else args or None)
+        # Hand orjson's bytes straight to the response, skipping a str round trip.
+        return self._app.response_class(orjson.dumps(obj, option=self.option), mimetype="application/json")
+
 
 def create_app(config_class=Config):
     """
@@ -17,10 +115,17 @@ def create_app(config_class=Config):
     """
     app = Flask(__name__)
     app.config.from_object(config_class)
+    app.json = ORJSONProvider(app)
 
     # Initialize extensions
     db.init_app(app)
     JWTManager(app)
+    Compress(app)
+
+    # The page has no per-request data, so render it (and its ETag) once
+    with app.test_request_context("/"):
+        index_html = render_template("index.html")
+    index_etag = hashlib.sha1(index_html.encode()).hexdigest()
 
     # ---- Helper Functions ----
 
@@ -28,26 +133,71 @@ def create_app(config_class=Config):
         """Helper to safely get JSON data from request."""
         return request.get_json(silent=True) or {}
 
-    def require_fields(data, *fields):
-        """Helper to validate that required fields exist in the request body."""
-        missing = [f for f in fields if not data.get(f)]
-        if missing:
+    def make_validator(*fields):
+        """
+        Build a validator for a fixed set of required request body fields.
+        Returns (True, None) or (False, error_response); the error list is only
+        built when something is actually missing.
+        """
+        checks = tuple(fields)
+
+        def validate(data):
+            for field in checks:
+                if not data.get(field):
+                    break
+            else:
+                return True, None
+            missing = [f for f in checks if not data.get(f)]
             return False, (jsonify({"error": f"missing field(s): {', '.join(missing)}"}), 400)
-        return True, None
+
+        return validate
+
+    validate_credentials = make_validator("username", "password")
+    validate_joke = make_validator("value")
+
+    def current_user_id():
+        """Helper to get the authenticated user's id straight from the JWT (no DB hit)."""
+        if "user_id" not in g:
+            try:
+                g.user_id = int(get_jwt_identity())
+            except (TypeError, ValueError):
+                abort(401)
+        return g.user_id
+
+    def current_username():
+        """Username from the JWT claim, falling back to the DB for older tokens."""
+        username = get_jwt().get("username")
+        return username if username is not None else current_user().username
 
     def current_user():
-        """Helper to get the current authenticated user object."""
-        identity = get_jwt_identity()
-        try:
-            user_id = int(identity)
-        except (TypeError, ValueError):
-            abort(401)
+        """Helper to get the current authenticated user object (cached per request)."""
+        if "user" in g:
+            return g.user
 
-        user = db.session.get(User, user_id)
+        user = db.session.get(User, current_user_id())
         if user is None:
             abort(401)
+        g.user = user
         return user
 
+    def unknown_user_error():
+        """
+        401 for an insert rejected by the users foreign key: the token is valid
+        but its user no longer exists (e.g. the DB was reset).
+        """
+        db.session.rollback()
+        return jsonify({"error": "user no longer exists"}), 401
+
+    def owned_by(user_id):
+        """SQL predicate for jokes the user may modify (their own or unowned)."""
+        return or_(Joke.user_id == user_id, Joke.user_id.is_(None))
+
+    def joke_write_error(joke_id):
+        """Explain why a guarded UPDATE/DELETE matched no rows: 403 if the joke exists."""
+        if db.session.scalar(select(Joke.id).where(Joke.id == joke_id)) is not None:
+            return jsonify({"error": "not authorised"}), 403
+        return jsonify({"error": "joke not found"}), 404
+
     # ---- CLI Commands ----
 
     @app.cli.command("init-db")
@@ -55,6 +205,22 @@ def create_app(config_class=Config):
         """Command to create database tables."""
         with app.app_context():
             db.create_all()
+            # create_all skips existing tables, so add any newer indexes separately
+            for index in Joke.__table__.indexes:
+                index.create(db.engine, checkfirst=True)
+            # Bring an older Postgres jokes table in line with the server-side timestamp.
+            # Only runs while the column is still naive, so re-running is a no-op.
+            if db.engine.dialect.name == "postgresql":
+                columns = {c["name"]: c for c in inspect(db.engine).get_columns("jokes")}
+                created_at = columns["created_at"]
+                with db.engine.begin() as conn:
+                    if not getattr(created_at["type"], "timezone", False):
+                        conn.execute(text(
+                            "ALTER TABLE jokes ALTER COLUMN created_at TYPE TIMESTAMP WITH TIME ZONE "
+                            "USING created_at AT TIME ZONE 'UTC'"
+                        ))
+                    if created_at["default"] is None:
+                        conn.execute(text("ALTER TABLE jokes ALTER COLUMN created_at SET DEFAULT now()"))
             print("Database tables created successfully.")
 
     # ---- Authentication Routes ----
@@ -62,14 +228,14 @@ def create_app(config_class=Config):
     @app.post("/auth/register")
     def register():
         data = json_body()
-        ok, resp = require_fields(data, "username", "password")
+        ok, resp = validate_credentials(data)
         if not ok:
             return resp
 
         username = data["username"]
         password = data["password"]
 
-        if User.query.filter_by(username=username).first():
+        if db.session.scalars(_USER_BY_NAME, {"u": username}).first():
             return jsonify({"error": "username already exists"}), 400
 
         # Create new user with hashed password
@@ -83,97 +249,166 @@ def create_app(config_class=Config):
     @app.post("/auth/login")
     def login():
         data = json_body()
-        ok, resp = require_fields(data, "username", "password")
+        ok, resp = validate_credentials(data)
         if not ok:
             return resp
 
         username = data["username"]
         password = data["password"]
 
-        user = User.query.filter_by(username=username).first()
+        user = db.session.scalars(_USER_BY_NAME, {"u": username}).first()
         
         # Check password hash
         if user is None or not user.check_password(password):
             return jsonify({"error": "invalid credentials"}), 401
 
+        # Upgrade legacy hashes transparently now that we know the password
+        if user.password_needs_rehash():
+            user.set_password(password)
+            db.session.commit()
+
         # Identity must be a string for JWT
-        token = create_access_token(identity=str(user.id))
+        # Username rides along as a claim so endpoints can skip loading the User row
+        token = create_access_token(identity=str(user.id), additional_claims={"username": user.username})
         return jsonify({"access_token": token}), 200
 
     # ---- UI Routes ----
 
     @app.get("/")
     def frontend():
-        """Serve the main page."""
-        return render_template("index.html"), 200
+        """Serve the main page (pre-rendered; answers 304 to a matching If-None-Match)."""
+        resp = Response(index_html, 200, mimetype="text/html")
+        # Weak ETag: Flask-Compress leaves it untouched, so a repeat view's
+        # If-None-Match matches here and the 304 skips compression entirely.
+        resp.set_etag(index_etag, weak=True)
+        resp.headers["Cache-Control"] = "public, max-age=300"
+        return resp.make_conditional(request)
+
+    # ---- Request Aggregation ----
+
+    @app.post("/batch")
+    def aggregate():
+        """
+        Runs several GET requests in one round trip.
+        Body is a JSON list of paths, e.g. ["/categories", "/jokes"]; the caller's
+        Authorization header is forwarded to each sub-request.
+        """
+        paths = request.get_json(silent=True)
+        if not isinstance(paths, list) or not paths:
+            return jsonify({"error": "expected a non-empty JSON list of paths"}), 400
+        if len(paths) > MAX_AGGREGATE:
+            return jsonify({"error": f"at most {MAX_AGGREGATE} paths per batch"}), 400
+        if not all(isinstance(p, str) and p.startswith("/") for p in paths):
+            return jsonify({"error": "paths must be strings starting with '/'"}), 400
+        if any(p.startswith("/batch") for p in paths):
+            return jsonify({"error": "/batch cannot be nested"}), 400
+
+        headers = {}
+        if "Authorization" in request.headers:
+            headers["Authorization"] = request.headers["Authorization"]
+
+        results = {}
+        for path in paths:
+            with app.test_request_context(path, method="GET", headers=headers):
+                try:
+                    rv = app.full_dispatch_request()
+                    results[path] = {"status": rv.status_code, "body": rv.get_json(silent=True)}
+                except Exception:
+                    # Sub-requests share one DB session; don't let a failure leak into the next
+                    app.logger.exception("batch sub-request %s failed", path)
+                    db.session.rollback()
+                    results[path] = {"status": 500, "body": None}
+        return jsonify(results), 200
 
     # ---- Joke CRUD Operations ----
 
     @app.get("/jokes")
     @jwt_required()
     def list_jokes():
-        user = current_user()
-        jokes = Joke.query.filter_by(user_id=user.id).all()
-        return jsonify({"jokes": [j.to_dict() for j in jokes]}), 200
+        """
+        Streams the user's jokes as {"jokes": [...]}, encoding rows as they
+        are read from the DB instead of building the whole list first.
+        """
+        user_id = current_user_id()
+        username = current_username()
+        stmt = (
+            select(Joke)
+            .where(Joke.user_id == user_id)
+            .order_by(Joke.id)
+            .execution_options(yield_per=200)
+        )
+
+        def generate():
+            yield b'{"jokes":['
+            sep = b""
+            for joke in db.session.scalars(stmt):
+                # Every joke here belongs to `user_id`, so reuse `username` instead of
+                # lazy-loading the author per row.
+                yield sep + orjson.dumps(joke.to_dict(username), option=ORJSONProvider.option)
+                sep = b","
+            yield b"]}"
+
+        return Response(stream_with_context(generate()), 200, mimetype="application/json")
 
     @app.get("/jokes/<int:joke_id>")
     @jwt_required()
     def get_joke(joke_id):
-        user = current_user()
         joke = db.session.get(Joke, joke_id)
-        
+
         # Ensure user owns the joke
-        if not joke or joke.user_id != user.id:
+        if not joke or joke.user_id != current_user_id():
             return jsonify({"error": "joke not found"}), 404
-        return jsonify(joke.to_dict()), 200
+        return jsonify(joke.to_dict(current_username())), 200
     
     @app.post("/jokes")
     @jwt_required()
     def create_joke():
         data = json_body()
-        ok, resp = require_fields(data, "value")
+        ok, resp = validate_joke(data)
         if not ok:
             return resp
 
-        user = current_user()
         # Custom jokes don't have an external ID or category by default
-        joke = Joke(joke_id=None, value=data["value"], category=None, user_id=user.id)
+        joke = Joke(joke_id=None, value=data["value"], category=None, user_id=current_user_id())
         db.session.add(joke)
+        try:
+            db.session.flush()
+        except IntegrityError:
+            return unknown_user_error()
+        payload = joke.to_dict(current_username())
         db.session.commit()
-        return jsonify(joke.to_dict()), 201
+        return jsonify(payload), 201
 
     @app.put("/jokes/<int:joke_id>")
     @jwt_required()
     def update_joke(joke_id):
-        joke = Joke.query.get(joke_id)
-        if not joke:
-            return jsonify({"error": "joke not found"}), 404
-
-        user = current_user()
-        if joke.user_id is not None and joke.user_id != user.id:
-            return jsonify({"error": "not authorised"}), 403
-
         data = json_body()
-        ok, resp = require_fields(data, "value")
+        ok, resp = validate_joke(data)
         if not ok:
             return resp
 
-        joke.value = data["value"]
+        # Ownership is checked in the UPDATE itself, saving a separate SELECT
+        stmt = (
+            update(Joke)
+            .where(Joke.id == joke_id, owned_by(current_user_id()))
+            .values(value=data["value"])
+            .returning(Joke)
+        )
+        joke = db.session.scalars(stmt).first()
+        if joke is None:
+            return joke_write_error(joke_id)
+
+        payload = joke.to_dict(current_username() if joke.user_id is not None else None)
         db.session.commit()
-        return jsonify(joke.to_dict()), 200
+        return jsonify(payload), 200
 
     @app.delete("/jokes/<int:joke_id>")
     @jwt_required()
     def delete_joke(joke_id):
-        joke = Joke.query.get(joke_id)
-        if not joke:
-            return jsonify({"error": "joke not found"}), 404
-
-        user = current_user()
-        if joke.user_id is not None and joke.user_id != user.id:
-            return jsonify({"error": "not authorised"}), 403
+        stmt = delete(Joke).where(Joke.id == joke_id, owned_by(current_user_id())).returning(Joke.id)
+        if db.session.execute(stmt).first() is None:
+            return joke_write_error(joke_id)
 
-        db.session.delete(joke)
         db.session.commit()
         return jsonify({"message": "deleted"}), 200
 
@@ -182,14 +417,28 @@ def create_app(config_class=Config):
     @app.get("/categories")
     @jwt_required()
     def categories():
-        """Fetches categories from the external Chuck Norris API."""
-        try:
-            resp = requests.get(f"{CHUCK_API_BASE}/categories", timeout=5)
-            resp.raise_for_status()
-        except requests.RequestException:
+        """Fetches categories from the external Chuck Norris API (cached)."""
+        cats, failed = cached_categories()
+        if cats is None and not failed:
+            with _cat_fetch_lock:
+                # Another thread may have refreshed the cache while we waited
+                cats, failed = cached_categories()
+                if cats is None and not failed:
+                    try:
+                        resp = _chuck_session.get(f"{CHUCK_API_BASE}/categories", timeout=5)
+                        resp.raise_for_status()
+                        cats = resp.json()
+                    except requests.RequestException:
+                        failed = True
+                    with _cat_lock:
+                        if failed:
+                            _cat_fail_cache["v"] = True
+                        else:
+                            _cat_cache["v"] = cats
+        if cats is None:
             return jsonify({"error": "failed to fetch categories"}), 502
 
-        return jsonify({"categories": resp.json()}), 200
+        return jsonify({"categories": cats}), 200, {"Cache-Control": f"public, max-age={CATEGORIES_TTL}"}
 
     @app.get("/random")
     @jwt_required()
@@ -198,33 +447,88 @@ def create_app(config_class=Config):
         Fetches a random joke from the external API and saves it to the DB.
         Supports filtering by category query param.
         """
-        user = current_user()
-
-        selected_category = request.args.get("category")
-        params = {"category": selected_category} if selected_category else None
-
+        # Call the external API before touching the DB so a pooled connection
+        # is not held open while waiting on the upstream round trip.
         try:
-            resp = requests.get(f"{CHUCK_API_BASE}/random", params=params, timeout=5)
-            resp.raise_for_status()
+            external_id, value, category = fetch_random_joke(request.args.get("category"))
         except requests.RequestException:
             return jsonify({"error": "failed to fetch joke from external API"}), 502
 
-        data = resp.json()
-        external_id = data.get("id")
-        value = data.get("value")
-        cats = data.get("categories") or []
-        category = cats[0] if cats else None
+        user_id = current_user_id()
+        username = current_username()
 
-        # Check if we already have this joke for this user
-        existing = Joke.query.filter_by(joke_id=external_id, user_id=user.id).first()
-        if existing:
-            return jsonify(existing.to_dict()), 200
+        # Save the joke in one statement; the unique constraint skips duplicates
+        stmt = (
+            upsert_insert(Joke)
+            .values(joke_id=external_id, value=value, category=category, user_id=user_id)
+            .on_conflict_do_nothing(index_elements=["joke_id", "user_id"])
+            .returning(Joke)
+        )
+        try:
+            joke = db.session.scalars(stmt).first()
+        except IntegrityError:
+            return unknown_user_error()
+        if joke is not None:
+            payload = joke.to_dict(username)
+            db.session.commit()
+            return jsonify(payload), 201
+
+        # Already saved for this user
+        existing = db.session.scalars(
+            select(Joke).where(Joke.joke_id == external_id, Joke.user_id == user_id)
+        ).first()
+        if existing is None:
+            # Deleted between the skipped insert and this lookup
+            return jsonify({"error": "joke not found"}), 404
+        return jsonify(existing.to_dict(username)), 200
 
-        # Save new joke
-        joke = Joke(joke_id=external_id, value=value, category=category, user_id=user.id)
-        db.session.add(joke)
+    @app.get("/random/batch")
+    @jwt_required()
+    def random_joke_batch():
+        """
+        Fetches `n` random jokes concurrently and saves any new ones in one insert.
+        Supports the same category query param as /random.
+        """
+        try:
+            n = int(request.args.get("n", 10))
+        except ValueError:
+            return jsonify({"error": "n must be an integer"}), 400
+        if not 1 <= n <= MAX_BATCH:
+            return jsonify({"error": f"n must be between 1 and {MAX_BATCH}"}), 400
+
+        selected_category = request.args.get("category")
+        try:
+            fetched = list(_fetch_pool.map(fetch_random_joke, [selected_category] * n))
+        except requests.RequestException:
+            return jsonify({"error": "failed to fetch jokes from external API"}), 502
+
+        user_id = current_user_id()
+        username = current_username()
+
+        # The upstream API may repeat itself; keep one row per external id.
+        by_id = {ext_id: (value, category) for ext_id, value, category in fetched}
+        rows = [
+            {"joke_id": ext_id, "value": value, "category": category, "user_id": user_id}
+            for ext_id, (value, category) in by_id.items()
+        ]
+
+        # One atomic insert; jokes the user already has are skipped by the unique constraint
+        stmt = (
+            upsert_insert(Joke)
+            .values(rows)
+            .on_conflict_do_nothing(index_elements=["joke_id", "user_id"])
+            .returning(Joke.id)
+        )
+        try:
+            saved = len(db.session.execute(stmt).all())
+        except IntegrityError:
+            return unknown_user_error()
         db.session.commit()
-        return jsonify(joke.to_dict()), 201
+
+        jokes = db.session.scalars(
+            select(Joke).where(Joke.user_id == user_id, Joke.joke_id.in_(by_id)).order_by(Joke.id)
+        )
+        return jsonify({"jokes": [j.to_dict(username) for j in jokes], "saved": saved}), 200
 
     return app
 
@@ -10,7 +10,20 @@ class Config:
     SECRET_KEY = os.environ.get("SECRET_KEY", "change-me-please")
     SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", "sqlite:///app.db")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Larger compiled-statement cache plus a pool sized for concurrent workers.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "query_cache_size": 1200,
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
+    if not SQLALCHEMY_DATABASE_URI.startswith("sqlite"):
+        SQLALCHEMY_ENGINE_OPTIONS.update({"pool_size": 20, "max_overflow": 10})
     JWT_SECRET_KEY = os.environ.get("JWT_SECRET_KEY", "another-secret")
+    # Response compression (Flask-Compress); joke JSON compresses well
+    COMPRESS_ALGORITHM = ["br", "gzip"]
+    COMPRESS_MIN_SIZE = 500
+    # Streamed responses (GET /jokes) can't be gzipped and ignore COMPRESS_MIN_SIZE
+    COMPRESS_ALGORITHM_STREAMING = ["br", "deflate"]
     FLASK_HTTPS = os.environ.get("FLASK_HTTPS", "false").lower()
 
 def get_ssl_context():
@@ -1,9 +1,15 @@
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import check_password_hash, generate_password_hash
-from datetime import datetime
+from sqlalchemy import func
+from werkzeug.security import check_password_hash
 
 db = SQLAlchemy()
 
+# Argon2id with OWASP's minimum parameters: memory-hard, and much cheaper per
+# login than Werkzeug's default high-iteration PBKDF2.
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
 class User(db.Model):
     """Simple user model with hashed password storage."""
     __tablename__ = "users"
@@ -17,11 +23,25 @@ class User(db.Model):
 
     def set_password(self, password):
         """Hash and store a password."""
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        """Validate a password against the stored hash."""
-        return check_password_hash(self.password_hash, password)
+        """
+        Validate a password against the stored hash.
+        Legacy Werkzeug PBKDF2 hashes are still accepted.
+        """
+        if not self.password_hash.startswith("$argon2"):
+            return check_password_hash(self.password_hash, password)
+        try:
+            return password_hasher.verify(self.password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+
+    def password_needs_rehash(self):
+        """True if the stored hash is legacy or uses outdated Argon2 parameters."""
+        if not self.password_hash.startswith("$argon2"):
+            return True
+        return password_hasher.check_needs_rehash(self.password_hash)
 
     def __repr__(self):
         return f"<User {self.username}>"
@@ -32,27 +52,39 @@ class Joke(db.Model):
     __tablename__ = "jokes"
     __table_args__ = (
         db.UniqueConstraint("joke_id", "user_id", name="uq_jokes_joke_id_user_id"),
+        # Serves list_jokes: WHERE user_id = ? ORDER BY id
+        db.Index("ix_jokes_user_id_id", "user_id", "id"),
     )
+    # Fetch server-generated values (created_at) via RETURNING on insert.
+    __mapper_args__ = {"eager_defaults": True}
 
     id = db.Column(db.Integer, primary_key=True)
     # External API joke ID (null for user-submitted jokes)
     joke_id = db.Column(db.String(64), index=True, nullable=True)
     value = db.Column(db.Text, nullable=False)
     category = db.Column(db.String(64))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Set by the database so inserts need no Python-side timestamp. The
+    # client-side SQL default renders now() into each INSERT, which keeps
+    # tables created before the server default existed working (e.g. SQLite).
+    created_at = db.Column(db.DateTime(timezone=True), default=func.now(), server_default=func.now())
 
     # Nullable: external jokes are not "authored" by a local user.
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     
-    def to_dict(self):
-        """Dictionary representation for API responses."""
+    def to_dict(self, username=None):
+        """
+        Dictionary representation for API responses.
+        Pass `username` when the author is already known to skip loading it.
+        """
+        if username is None and self.user_id is not None:
+            username = self.author.username if self.author else None
         return {
             "id": self.id,
             "joke_id": self.joke_id,
             "value": self.value,
             "category": self.category,
-            "created_at": self.created_at.isoformat(),
-            "user": self.author.username if self.author else None,
+            "created_at": self.created_at,
+            "user": username,
         }
 
     def __repr__(self):
@@ -0,0 +1,9 @@
+"""
+WSGI entry point for production servers.
+
+    gunicorn -k gthread -w 4 --threads 8 --keep-alive 75 \
+        --certfile cert.pem --keyfile key.pem -b 0.0.0.0:5000 wsgi:application
+"""
+from app import create_app
+
+application = create_app()